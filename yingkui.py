@@ -2,50 +2,131 @@ import streamlit as st
 import yfinance as yf
 import pandas as pd
 import requests
+import requests_cache
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 # 页面配置
 st.set_page_config(page_title="美股盈亏结算-专业版", layout="wide")
 
+# --- 核心函数：HTTP 会话 (磁盘缓存) ---
+QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+UA_HEADERS = {"User-Agent": "Mozilla/5.0"}
+FX_URLS = [
+    "https://open.er-api.com/v6/latest/USD",
+    "https://api.exchangerate-api.com/v4/latest/USD"
+]
+
+@st.cache_resource
+def get_session():
+    """SQLite 落盘的 HTTP 缓存，rerun / 重启后 60s 内不再重复请求 Yahoo"""
+    session = requests_cache.CachedSession("yf_cache", expire_after=60, backend="sqlite")
+    session.headers.update(UA_HEADERS)
+    return session
+
+@st.cache_resource
+def get_executor():
+    """全局共享的线程池，避免每次 rerun 新建线程"""
+    return ThreadPoolExecutor(max_workers=16)
+
+@st.cache_resource
+def get_panel_executor():
+    """行情面板并发拉汇率/股价用的线程池；其任务会等待 get_executor() 的任务，分开以免同池嵌套死锁"""
+    return ThreadPoolExecutor(max_workers=8)
+
 # --- 核心函数：获取汇率 (多源冗余) ---
-@st.cache_data(ttl=3600)
+@st.cache_data(ttl=3600, show_spinner=False)
 def fetch_usd_cny():
-    """尝试从多个公开API获取汇率"""
-    urls = [
-        "https://open.er-api.com/v6/latest/USD",
-        "https://api.exchangerate-api.com/v4/latest/USD"
-    ]
-    for url in urls:
+    """并发请求多个公开API获取汇率"""
+    session = get_session()
+    # 多源同时请求，取最先成功的一个；慢源留在共享线程池里自行结束，不拖累整体
+    futs = [get_executor().submit(session.get, url, timeout=5, expire_after=3600) for url in FX_URLS]
+    for fut in as_completed(futs):
+        if fut.exception() is not None:
+            continue
+        res = fut.result()
+        if res.status_code != 200 or 'json' not in res.headers.get('Content-Type', ''):
+            continue
         try:
-            res = requests.get(url, timeout=5)
-            if res.status_code == 200:
-                return res.json()['rates']['CNY']
-        except:
+            return float(res.json()['rates']['CNY'])
+        except (ValueError, TypeError, KeyError):
+            # JSON 损坏 / rates 为 null / 缺 CNY：换下一个源
             continue
     return 7.25  # 最终兜底汇率
 
+# --- 核心函数：Yahoo 凭证 (cookie + crumb) ---
+@st.cache_resource
+def get_yahoo_credentials():
+    """两步获取 Yahoo 凭证: 先拿 cookie (存于共享 session)，再换 crumb；失败则抛出，不会被缓存"""
+    session = get_session()
+    # 凭证必须真实请求，否则拿不到 cookie；按请求绕过缓存 (cache_disabled() 会影响共享 session 上的其他线程)
+    no_cache = {"force_refresh": True, "expire_after": requests_cache.DO_NOT_CACHE}
+    # fc.yahoo.com 正常就返回 404，只要设置了 cookie 即算成功
+    res = session.get("https://fc.yahoo.com", timeout=5, **no_cache)
+    if not res.cookies:
+        raise requests.HTTPError(f"Yahoo 未下发 cookie (HTTP {res.status_code})", response=res)
+    res = session.get("https://query1.finance.yahoo.com/v1/test/getcrumb", timeout=5, **no_cache)
+    res.raise_for_status()
+    if not res.text:
+        raise requests.HTTPError("Yahoo 返回空 crumb", response=res)
+    return res.text
+
 # --- 核心函数：获取股价 ---
-@st.cache_data(ttl=60)
-def fetch_prices(tickers):
-    """从 yfinance 获取最新价格"""
+def fetch_one_price(t):
+    """yfinance 单只补价，只拉 1 日 history；取不到返回 None"""
+    # 并发由 get_executor() 在 Ticker 层负责，不用 yf.download 的内部线程
+    # 仅此一次限时 3s 的请求；超时会被 yfinance 吞掉并返回空表，不再追加 fast_info (1 年日线、默认超时)
     try:
-        # 使用 download 快速获取多个代码
-        df = yf.download(tickers, period="1d", interval="1m", progress=False)
-        if df.empty: return None
-        
-        current_prices = {}
-        for t in tickers:
-            # 提取最后一行有效的收盘价
-            price = df['Close'][t].dropna().iloc[-1]
-            current_prices[t] = price
-        return current_prices
-    except Exception as e:
-        st.error(f"股价获取失败: {e}")
-        return None
+        h = yf.Ticker(t).history(period="1d", timeout=3)
+        return t, (h['Close'].iloc[-1] if not h.empty else None)
+    except Exception:
+        # 限流 (YFRateLimitError) 等异常只影响这一只，不拖垮整批
+        return t, None
+
+def fetch_quote_prices(tickers):
+    """一次请求 Yahoo v7 quote 接口获取最新价格，失败时抛出"""
+    res = get_session().get(
+        QUOTE_URL,
+        params={"symbols": ",".join(tickers), "crumb": get_yahoo_credentials()},
+        timeout=5
+    )
+    if res.status_code == 401:
+        # crumb 失效，清掉缓存的凭证，下次重新握手
+        get_yahoo_credentials.clear()
+    res.raise_for_status()
+    quotes = res.json()['quoteResponse']['result']
+    return {q['symbol']: q['regularMarketPrice'] for q in quotes if 'regularMarketPrice' in q}
+
+QUOTE_BACKOFF = 120  # quote 接口失败后的退避时长 (秒)
+
+@st.cache_resource
+def get_quote_backoff():
+    """跨会话共享的 quote 接口退避截止时间"""
+    return {"until": 0.0}
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_prices(tickers):
+    """优先走 quote 接口，取不到的代码 (或接口失败/退避期间全部) 退回 yfinance"""
+    backoff = get_quote_backoff()
+    current_prices = {}
+    if time.time() >= backoff["until"]:
+        try:
+            current_prices = fetch_quote_prices(tickers)
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            # crumb / 401 / 429 / 网络异常：整批交给 yfinance，退避期内不再反复握手
+            backoff["until"] = time.time() + QUOTE_BACKOFF
+
+    # quote 接口未返回的代码，退回 yfinance 并发补齐
+    missing = [t for t in tickers if t not in current_prices]
+    if missing:
+        current_prices.update(
+            (t, p) for t, p in get_executor().map(fetch_one_price, missing) if p is not None
+        )
+    return current_prices
 
 # --- UI 界面 ---
 st.title("📊 个人股票持仓盈亏分析系统")
-st.markdown(f"> **当前同步时间**: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} (USD/CNY 汇率每小时更新)")
 
 # 提示栏
 with st.expander("📝 填表说明 & 风险告知"):
@@ -53,7 +134,7 @@ with st.expander("📝 填表说明 & 风险告知"):
     - 数据源: yfinance (延迟 15-20 min)。
     - **RZLT**: 生物医药类，波动大。
     - **RKLX/CRWG**: 2倍杠杆 ETF，存在调仓损耗，不建议长期无视风险持有。
-    - **工艺提醒**: 系统已设置 60s 缓存，频繁刷新不会立即改变数据。
+    - **工艺提醒**: 行情缓存 60s、汇率缓存 1 小时，频繁刷新不会立即改变行情；「刷新全盘数据」会重新拉取汇率。
     """)
 
 # 初始数据
@@ -61,79 +142,118 @@ default_stocks = {
     "RKLX": {"name": "2X Long RKLB", "qty": 20.33, "cost": 45.64},
     "CRWG": {"name": "2X Long CRWV", "qty": 233.6, "cost": 3.83}
 }
+# 列式表便于后续整列运算；只有两行，每次 rerun 直接重建，改持仓后立即生效
+default_port = pd.DataFrame.from_dict(default_stocks, orient="index")
+tickers = default_port.index.tolist()
 
 # 输入区
 st.subheader("⚙️ 参数输入")
-input_data = {}
+qtys, costs = [], []
 cols = st.columns(3)
 
-for i, (ticker, info) in enumerate(default_stocks.items()):
+for i, row in enumerate(default_port.itertuples()):
     with cols[i]:
-        st.markdown(f"**{ticker}** ({info['name']})")
-        q = st.number_input("股数", value=info['qty'], key=f"q_{ticker}", format="%.2f")
-        c = st.number_input("成本/股 ($)", value=info['cost'], key=f"c_{ticker}", format="%.2f")
-        input_data[ticker] = {"qty": q, "cost": c}
+        st.markdown(f"**{row.Index}** ({row.name})")
+        qtys.append(st.number_input("股数", value=row.qty, key=f"q_{row.Index}", format="%.2f"))
+        costs.append(st.number_input("成本/股 ($)", value=row.cost, key=f"c_{row.Index}", format="%.2f"))
 
 # 动作按钮
 if st.button("🔄 刷新全盘数据", type="primary", use_container_width=True):
     st.cache_data.clear()
+    # 汇率在磁盘缓存里存 1 小时，手动刷新时一并清掉
+    get_session().cache.delete(urls=FX_URLS)
     st.rerun()
 
-# --- 计算逻辑 ---
-prices = fetch_prices(list(default_stocks.keys()))
-rate = fetch_usd_cny()
-
-if prices:
-    rows = []
-    total_cost_u, total_val_u = 0, 0
-
-    for ticker, vals in input_data.items():
-        p = prices[ticker]
-        cost_u = vals['qty'] * vals['cost']
-        val_u = vals['qty'] * p
-        profit_u = val_u - cost_u
-        pct = (profit_u / cost_u * 100) if cost_u != 0 else 0
-        
-        total_cost_u += cost_u
-        total_val_u += val_u
-        
-        rows.append({
-            "代码": ticker,
-            "现价($)": f"{p:.3f}",
-            "持有量": vals['qty'],
-            "成本($)": f"{vals['cost']:.2f}",
-            "市值($)": round(val_u, 2),
-            "市值(¥)": round(val_u * rate, 2),
-            "盈亏(¥)": round(profit_u * rate, 2),
-            "盈亏率": pct
-        })
-
-    # 汇总计算
-    total_p_u = total_val_u - total_cost_u
-    total_pct = (total_p_u / total_cost_u * 100) if total_cost_u != 0 else 0
-    
-    # 构建 DataFrame
-    df = pd.DataFrame(rows)
-    
-    # 样式美化
-    def style_profit(val):
-        color = 'red' if val < 0 else 'green'
-        icon = '▼' if val < 0 else '▲'
-        return f'color: {color}; font-weight: bold;'
-
-    # 展示汇总卡片
-    c1, c2, c3 = st.columns(3)
-    c1.metric("总资产 (¥)", f"{total_val_u * rate:,.2f}")
-    c2.metric("总盈亏 (¥)", f"{total_p_u * rate:,.2f}", f"{total_pct:.2f}%")
-    c3.metric("当前汇率", f"{rate:.4f}")
+# 汇总卡片模板
+SUMMARY_TEMPLATE = """
+<div style="display: flex; gap: 1rem;">
+  <div style="flex: 1;"><small>总资产 (¥)</small><h2 style="margin: 0;">{total_val}</h2></div>
+  <div style="flex: 1;"><small>总盈亏 (¥)</small><h2 style="margin: 0;">{total_p}</h2>
+    <span style="color: {pct_color};">{total_pct}</span></div>
+  <div style="flex: 1;"><small>当前汇率</small><h2 style="margin: 0;">{rate}</h2></div>
+</div>
+"""
+
+# --- 行情面板：每 60s 只重跑这一块，不重建整页 ---
+@st.fragment(run_every=60)
+def prices_panel(qtys, costs):
+    st.markdown(f"> **当前同步时间**: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} (USD/CNY 汇率每小时更新)")
 
+    # 结果区：先渲染占位，行情到达后再填充
+    summary_slot = st.empty()
     st.subheader("📋 详细清单")
-    st.dataframe(
-        df.style.applymap(style_profit, subset=['盈亏(¥)', '盈亏率']),
-        use_container_width=True
-    )
-else:
-    st.warning("正在连接行情服务器，请稍候或检查网络...")
+    table_slot = st.empty()
+
+    # 计算逻辑
+    # 汇率与股价互不依赖，并发请求；子线程无法渲染 UI，报错统一回主线程处理
+    with st.spinner("加载行情..."):
+        ex = get_panel_executor()
+        f_rate = ex.submit(fetch_usd_cny)
+        f_px = ex.submit(fetch_prices, tickers)
+        rate = f_rate.result()
+        try:
+            prices = f_px.result()
+        except Exception as e:
+            st.error(f"股价获取失败: {e}")
+            prices = None
+
+    if prices:
+        # 整列运算，避免逐行 Python 循环
+        port = pd.DataFrame({"qty": qtys, "cost": costs}, index=default_port.index)
+        port['cost_u'] = port['qty'] * port['cost']
+        port['cur'] = port.index.map(prices)
+        # 没拿到报价的代码不参与汇总，否则成本计入而市值缺失
+        no_quote = port.index[port['cur'].isna()].tolist()
+        if no_quote:
+            st.warning(f"以下代码暂无报价，已从汇总中剔除: {', '.join(no_quote)}")
+            port = port.dropna(subset=['cur'])
+        port['val_u'] = port['qty'] * port['cur']
+        port['profit_u'] = port['val_u'] - port['cost_u']
+        pct = (port['profit_u'] / port['cost_u'] * 100).where(port['cost_u'] != 0, 0.0)
+
+        # 汇总计算
+        total_cost_u, total_val_u = port[['cost_u', 'val_u']].sum()
+        total_p_u = total_val_u - total_cost_u
+        total_pct = (total_p_u / total_cost_u * 100) if total_cost_u != 0 else 0
+
+        # 构建 DataFrame
+        df = pd.DataFrame({
+            "代码": port.index,
+            "现价($)": port['cur'],
+            "持有量": port['qty'],
+            "成本($)": port['cost'],
+            "市值($)": port['val_u'].round(2),
+            "市值(¥)": (port['val_u'] * rate).round(2),
+            "盈亏(¥)": (port['profit_u'] * rate).round(2),
+            "盈亏率": pct
+        }).reset_index(drop=True)
+
+        # 填充汇总卡片：一次性渲染一段 HTML，而不是三个 metric 组件
+        summary_slot.html(SUMMARY_TEMPLATE.format(
+            total_val=f"{total_val_u * rate:,.2f}",
+            total_p=f"{total_p_u * rate:,.2f}",
+            pct_color="red" if total_pct < 0 else "green",
+            total_pct=f"{total_pct:+.2f}%",
+            rate=f"{rate:.4f}"
+        ))
+
+        table_slot.dataframe(
+            df,
+            use_container_width=True,
+            # 直接传数值表走 Arrow 传输，格式与正负号交给前端渲染
+            column_config={
+                "现价($)": st.column_config.NumberColumn(format="%.3f"),
+                "成本($)": st.column_config.NumberColumn(format="%.2f"),
+                "市值($)": st.column_config.NumberColumn(format="%.2f"),
+                "市值(¥)": st.column_config.NumberColumn(format="%.2f"),
+                "盈亏(¥)": st.column_config.NumberColumn(format="%+.2f"),
+                "盈亏率": st.column_config.ProgressColumn(format="%.2f%%", min_value=-100, max_value=100),
+            }
+        )
+    else:
+        table_slot.warning("正在连接行情服务器，请稍候或检查网络...")
+
+prices_panel(qtys, costs)
 
 st.divider()
 st.caption("Developed by Gemini for Engineering Excellence. 🛠️")